@@ -14,7 +14,13 @@ non_registered_folder = "/data/xenonnt_unregistered/"
 
 
 class DataBases:
-    def __init__(self, production=False):
+    def __init__(self, production=False, **client_kwargs):
+        """Connections to the DAQ database and the runs database.
+
+        :param production: if True, use the admin account on the runs database
+        :param client_kwargs: options for the MongoClients, e.g. appname or maxPoolSize
+
+        """
         self.production = production
         # DAQ database
         daq_db_name = "daq"
@@ -24,7 +30,7 @@ class DataBases:
             pwd_key="mongo_daq_password",
             url_key="mongo_daq_url",
         )
-        daq_client = pymongo.MongoClient(daq_uri)
+        daq_client = pymongo.MongoClient(daq_uri, **client_kwargs)
         self.daq_db = daq_client[daq_db_name]
         self.bs_coll = self.daq_db["eb_monitor"]
         self.ag_stat_coll = self.daq_db["aggregate_status"]
@@ -33,12 +39,21 @@ class DataBases:
         # Runs database
         run_dbname = straxen.uconfig.get("rundb_admin", "mongo_rdb_database")
         run_collname = "runs"
-        if production:
+        if production and not client_kwargs:
             self.run_db = self.get_admin_client()[run_dbname]
         else:
-            # Please note, this is a read only account on the rundb
-            run_uri = straxen.get_mongo_uri()
-            run_client = pymongo.MongoClient(run_uri)
+            if production:
+                # The admin client from utilix takes no options, make our own
+                run_uri = straxen.get_mongo_uri(
+                    header="rundb_admin",
+                    user_key="mongo_rdb_username",
+                    pwd_key="mongo_rdb_password",
+                    url_key="mongo_rdb_url",
+                )
+            else:
+                # Please note, this is a read only account on the rundb
+                run_uri = straxen.get_mongo_uri()
+            run_client = pymongo.MongoClient(run_uri, **client_kwargs)
             self.run_db = run_client[run_dbname]
         self.run_coll = self.run_db[run_collname]
 
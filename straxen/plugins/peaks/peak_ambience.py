@@ -6,6 +6,13 @@ import straxen
 
 export, __all__ = strax.exporter()
 
+# The ambience kernels are kept in numba rather than a compiled extension with
+# hand-written intrinsics: straxen ships no compiled code, and with the flags
+# below numba already vectorizes the inner loops for the host CPU.
+# All fast-math flags except nnan and ninf: positions of peaks can be NaN,
+# and comparisons with them must keep failing for the distance cut
+FASTMATH_FLAGS = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
 
 @export
 class PeakAmbience(strax.OverlapWindowPlugin):
@@ -79,131 +86,282 @@ class PeakAmbience(strax.OverlapWindowPlugin):
         return dtype
 
     def setup(self):
-        self.to_pe = self.gain_model
+        self.to_pe = np.ascontiguousarray(self.gain_model, dtype=np.float64)
+        # Homogeneous tuple, so numba does not have to reflect a list
+        self.exponents = tuple(float(e) for e in self.ambience_exponents)
+        # The default exponents (-1, -1) have kernels without pow in the inner loop
+        if self.exponents[0] == -1.0:
+            self._lonehits_ambience = _lonehits_ambience_inv
+        else:
+            self._lonehits_ambience = _lonehits_ambience
+        if self.exponents == (-1.0, -1.0):
+            self._peaks_ambience = _peaks_ambience_inv
+        else:
+            self._peaks_ambience = _peaks_ambience
+        # Scratch buffers for the peaks ambience, reused (and grown) across chunks
+        self._num_array = np.zeros((0, 4), dtype=np.int16)
+        self._sum_array = np.zeros((0, 4), dtype=np.float32)
 
     def compute(self, lone_hits, peaks):
+        # Only the columns needed are sorted by center_time, not the whole peaks
         argsort = strax.stable_argsort(peaks["center_time"])
-        _peaks = peaks[argsort].copy()
         result = np.zeros(len(peaks), self.dtype)
-        _quick_assign(argsort, result, self.compute_ambience(lone_hits, peaks, _peaks))
+        result[argsort] = self.compute_ambience(lone_hits, peaks, argsort)
         return result
 
-    def compute_ambience(self, lone_hits, peaks, current_peak):
+    def compute_ambience(self, lone_hits, peaks, argsort):
         # 1. Initialization
-        result = np.zeros(len(current_peak), self.dtype)
+        result = np.zeros(len(peaks), self.dtype)
+        center_time = peaks["center_time"][argsort]
 
         # 2. Define time window for each peak,
         # we will find small peaks & lone hits within these time windows
-        roi = np.zeros(len(current_peak), dtype=strax.time_fields)
-        roi["time"] = current_peak["center_time"] - self.ambience_time_window_backward
-        roi["endtime"] = current_peak["center_time"]
+        window_start = center_time - self.ambience_time_window_backward
+        window_end = center_time
 
         # 3. Calculate number and area sum of lonehits before a peak
-        touching_windows = strax.touching_windows(lone_hits, roi)
+        # Only lonehits with positive area create ambience. Their area in PE is
+        # computed once here rather than per (peak, lonehit) pair. The windows
+        # are found among all lonehits, and then translated to indices among the
+        # ones with positive area
+        start_index, end_index = self.window_indices(
+            lone_hits["time"], strax.endtime(lone_hits), window_start, window_end
+        )
+        positive = lone_hits["area"] > 0
+        n_positive_before = np.zeros(len(lone_hits) + 1, dtype=np.int64)
+        np.cumsum(positive, out=n_positive_before[1:])
+        pe_area = lone_hits["area"][positive] * self.to_pe[lone_hits["channel"][positive]]
         # Calculating ambience
-        self.lonehits_ambience(
-            current_peak,
-            lone_hits,
-            touching_windows,
-            self.ambience_exponents,
+        self._lonehits_ambience(
+            center_time,
+            lone_hits["time"][positive],
+            pe_area.astype(np.float32),
+            n_positive_before[start_index],
+            n_positive_before[end_index],
+            self.exponents,
             result["n_lh_before"],
             result["s_lh_before"],
-            self.to_pe,
         )
 
-        # 4. Calculate number and area sum of small S0, S1, S2 before a peak
+        # 4. Calculate number and area sum of small S0, S1, S2 before a peak,
+        # and of small S2 near (in (x,y) space) a peak. All small peaks are
+        # gathered into a single stream, which is scanned once for all of them
+        small = np.zeros(len(peaks), dtype=bool)
         for stype, area in zip([0, 1, 2], self.ambience_area_parameters):
-            mask_pre = (peaks["type"] == stype) & (peaks["area"] < area)
-            touching_windows = strax.touching_windows(peaks[mask_pre], roi)
-            # Calculating ambience
-            self.peaks_ambience(
-                current_peak,
-                peaks[mask_pre],
-                touching_windows,
-                self.ambience_exponents,
-                -1,
-                result[f"n_s{stype}_before"],
-                result[f"s_s{stype}_before"],
-            )
-
-        # 5. Calculate number and area sum of small S2 near(in (x,y) space) a S2 peak
-        mask_pre = (peaks["type"] == 2) & (peaks["area"] < self.ambience_area_parameters[2])
-        touching_windows = strax.touching_windows(peaks[mask_pre], roi)
+            small |= (peaks["type"] == stype) & (peaks["area"] < area)
+        # Columns 0, 1, 2 are the S0, S1, S2 before a peak, column 3 the S2 near it
+        num_array, sum_array = self.scratch_arrays(len(peaks))
         # Calculating ambience
-        self.peaks_ambience(
-            current_peak,
-            peaks[mask_pre],
-            touching_windows,
-            self.ambience_exponents,
+        self._peaks_ambience(
+            center_time,
+            peaks["x"][argsort].astype(np.float32, copy=False),
+            peaks["y"][argsort].astype(np.float32, copy=False),
+            *self.gather_columns(peaks, np.flatnonzero(small), window_start, window_end),
+            self.exponents,
             self.ambient_radius,
-            result["n_s2_near"],
-            result["s_s2_near"],
+            num_array,
+            sum_array,
         )
+        for i, ambience in enumerate(["s0_before", "s1_before", "s2_before", "s2_near"]):
+            result[f"n_{ambience}"] = num_array[:, i]
+            result[f"s_{ambience}"] = sum_array[:, i]
 
-        # 6. Set time and endtime for peaks
-        result["time"] = current_peak["time"]
-        result["endtime"] = strax.endtime(current_peak)
+        # 5. Set time and endtime for peaks
+        result["time"] = peaks["time"][argsort]
+        result["endtime"] = strax.endtime(peaks)[argsort]
 
-        # 7. Calculate sum of small hits and peaks before a peak
-        result["s_before"] = (
-            result["s_lh_before"]
-            + result["s_s0_before"]
-            + result["s_s1_before"]
-            + result["s_s2_before"]
-        )
+        # 6. Calculate sum of small hits and peaks before a peak
+        # Accumulated in place to avoid temporary arrays
+        np.add(result["s_lh_before"], result["s_s0_before"], out=result["s_before"])
+        for ambience in ["s1_before", "s2_before"]:
+            np.add(result["s_before"], result[f"s_{ambience}"], out=result["s_before"])
         return result
 
+    def scratch_arrays(self, n):
+        """Zeroed views of length n of the number and area sum scratch buffers, the buffers
+        are only reallocated when a chunk has more peaks than any before."""
+        if len(self._num_array) < n:
+            self._num_array = np.zeros((n, 4), dtype=np.int16)
+            self._sum_array = np.zeros((n, 4), dtype=np.float32)
+        num_array, sum_array = self._num_array[:n], self._sum_array[:n]
+        num_array[:] = 0
+        sum_array[:] = 0
+        return num_array, sum_array
+
     @staticmethod
-    @numba.njit
+    def window_indices(time, endtime, window_start, window_end):
+        """Indices (start, exclusive end) into things sorted by time of the things touching each
+        time window [window_start, window_end), the same as strax.touching_windows gives.
+
+        The endtime of the things need not be sorted: like touching_windows, a window then starts
+        at the first thing that ends after window_start.
+
+        """
+        return (
+            np.searchsorted(np.maximum.accumulate(endtime), window_start, side="right"),
+            np.searchsorted(time, window_end, side="left"),
+        )
+
+    def gather_columns(self, peaks, idx, window_start, window_end):
+        """Gather the columns of peaks[idx] needed to calculate the ambience as contiguous arrays,
+        together with the indices of these peaks within the time windows."""
+        return (
+            peaks["center_time"][idx],
+            peaks["area"][idx].astype(np.float32, copy=False),
+            peaks["type"][idx],
+            peaks["x"][idx].astype(np.float32, copy=False),
+            peaks["y"][idx].astype(np.float32, copy=False),
+            *self.window_indices(
+                peaks["time"][idx], strax.endtime(peaks)[idx], window_start, window_end
+            ),
+        )
+
+
+def _make_lonehits_ambience(inverse):
+    """Build the kernel to find lonehits before a peak.
+
+    :param inverse: if True, the exponent of delta t is taken to be -1, so the score is area / dt
+        rather than a call to pow. The flag is a closure constant, so the branch is resolved at
+        compile time.
+
+    """
+
+    @numba.njit(fastmath=FASTMATH_FLAGS, cache=True)
     def lonehits_ambience(
-        peaks, pre_hits, touching_windows, exponents, num_array, sum_array, to_pe
+        peak_center_time,
+        pre_time,
+        pre_area,
+        start_index,
+        end_index,
+        exponents,
+        num_array,
+        sum_array,
     ):
-        # Function to find lonehits before a peak
-        # creating_hit is the lonehit creating ambience
-        # suspicious_peak is the suspicious peak in the ambience created by creating_hit
-        for p_i, suspicious_peak in enumerate(peaks):
-            indices = touching_windows[p_i]
-            for idx in range(indices[0], indices[1]):
-                creating_hit = pre_hits[idx]
-                dt = suspicious_peak["center_time"] - creating_hit["time"]
-                if (dt <= 0) or (creating_hit["area"] <= 0):
-                    continue
-                num_array[p_i] += 1
+        # The lonehits creating ambience and the suspicious peaks in the ambience
+        # created by them are given as columns, to avoid structured-array access.
+        # The values of the suspicious peak are bound once per peak.
+        # All lonehits in a window count, the sum is split over four independent
+        # accumulators so the additions do not wait on each other
+        exponent = np.float32(exponents[0])
+        for p_i in range(len(peak_center_time)):
+            center_time = peak_center_time[p_i]
+            start, end = start_index[p_i], end_index[p_i]
+            num_array[p_i] += end - start
+            unrolled_end = start + (end - start) // 4 * 4
+            acc0 = acc1 = acc2 = acc3 = 0.0
+            for idx in range(start, unrolled_end, 4):
+                # dt is within the time window, at most a few ms, so float32 is
+                # precise enough and keeps the arithmetic in single precision
+                dt0 = np.float32(center_time - pre_time[idx])
+                dt1 = np.float32(center_time - pre_time[idx + 1])
+                dt2 = np.float32(center_time - pre_time[idx + 2])
+                dt3 = np.float32(center_time - pre_time[idx + 3])
                 # Sometimes we may interested in sum of area / dt
-                s = creating_hit["area"] * to_pe[creating_hit["channel"]]
-                s *= dt ** exponents[0]
-                sum_array[p_i] += s
+                if inverse:
+                    acc0 += pre_area[idx] / dt0
+                    acc1 += pre_area[idx + 1] / dt1
+                    acc2 += pre_area[idx + 2] / dt2
+                    acc3 += pre_area[idx + 3] / dt3
+                else:
+                    acc0 += pre_area[idx] * dt0**exponent
+                    acc1 += pre_area[idx + 1] * dt1**exponent
+                    acc2 += pre_area[idx + 2] * dt2**exponent
+                    acc3 += pre_area[idx + 3] * dt3**exponent
+            for idx in range(unrolled_end, end):
+                dt = np.float32(center_time - pre_time[idx])
+                if inverse:
+                    acc0 += pre_area[idx] / dt
+                else:
+                    acc0 += pre_area[idx] * dt**exponent
+            sum_array[p_i] += (acc0 + acc1) + (acc2 + acc3)
 
-    @staticmethod
-    @numba.njit
+    return lonehits_ambience
+
+
+_lonehits_ambience = _make_lonehits_ambience(inverse=False)
+_lonehits_ambience_inv = _make_lonehits_ambience(inverse=True)
+
+
+def _make_peaks_ambience(inverse):
+    """Build the kernel to find S0, S1, S2 before and S2 near a peak.
+
+    :param inverse: if True, the exponents of (delta t, delta r) are taken to be (-1, -1), so the
+        score is area / dt / r rather than calls to pow. The flag is a closure constant, so the
+        branch is resolved at compile time.
+
+    """
+
+    @numba.njit(fastmath=FASTMATH_FLAGS, cache=True)
     def peaks_ambience(
-        peaks,
-        pre_peaks,
-        touching_windows,
+        peak_center_time,
+        peak_x,
+        peak_y,
+        pre_center_time,
+        pre_area,
+        pre_type,
+        pre_x,
+        pre_y,
+        start_index,
+        end_index,
         exponents,
         ambient_radius,
         num_array,
         sum_array,
     ):
-        # Function to find S0, S1, S2 before or near a peak
-        # creating_peak is the peak creating ambience
-        # suspicious_peak is the suspicious peak in the ambience created by creating_peak
-        for p_i, suspicious_peak in enumerate(peaks):
-            indices = touching_windows[p_i]
-            for idx in range(indices[0], indices[1]):
-                creating_peak = pre_peaks[idx]
-                r = distance_in_xy(suspicious_peak, creating_peak)
-                dt = suspicious_peak["center_time"] - creating_peak["center_time"]
-                if dt <= 0:
+        # The peaks creating ambience and the suspicious peaks in the ambience
+        # created by them are given as columns, to avoid structured-array access.
+        # The values of the suspicious peak are bound once per peak.
+        # Creating peaks of all types come in one stream, the S0, S1, S2 before
+        # a peak go to column pre_type, the S2 near a peak to column 3.
+        # The radius cut is done on the squared distance, the square root is only
+        # taken for accepted peaks when the distance enters the score.
+        # Suspicious peaks without (x,y), e.g. S1s, can have no S2 near them,
+        # so the distance test is skipped for them altogether
+        r2_max = ambient_radius * ambient_radius
+        exponent_dt, exponent_dr = np.float32(exponents[0]), np.float32(exponents[1])
+        for p_i in range(len(peak_center_time)):
+            center_time, x, y = peak_center_time[p_i], peak_x[p_i], peak_y[p_i]
+            test_near = (ambient_radius < 0) or (np.isfinite(x) and np.isfinite(y))
+            for idx in range(start_index[p_i], end_index[p_i]):
+                # Peaks touching the window can have their center after the suspicious peak
+                delta_t = center_time - pre_center_time[idx]
+                if delta_t <= 0:
+                    continue
+                # dt is within the time window, float32 is precise enough
+                dt = np.float32(delta_t)
+                stype = pre_type[idx]
+                num_array[p_i, stype] += 1
+                # Sometimes we may interested in sum of area / dt
+                if inverse:
+                    s = pre_area[idx] / dt
+                else:
+                    s = pre_area[idx] * dt**exponent_dt
+                sum_array[p_i, stype] += s
+                if (stype != 2) or not test_near:
                     continue
-                if (ambient_radius < 0) or (r <= ambient_radius):
-                    num_array[p_i] += 1
-                    # Sometimes we may interested in sum of area / dt
-                    s = creating_peak["area"] * dt ** exponents[0]
-                    # Sometimes we may interested in sum of area / r
-                    if ambient_radius > 0:
-                        s *= r ** exponents[1]
-                    sum_array[p_i] += s
+                r2 = 0.0
+                if ambient_radius >= 0:
+                    dx = x - pre_x[idx]
+                    dy = y - pre_y[idx]
+                    r2 = dx * dx + dy * dy
+                    # Written such that NaN positions are rejected
+                    if not r2 <= r2_max:
+                        continue
+                num_array[p_i, 3] += 1
+                # Sometimes we may interested in sum of area / r
+                if ambient_radius > 0:
+                    r = np.sqrt(r2)
+                    if inverse:
+                        s /= r
+                    else:
+                        s *= r**exponent_dr
+                sum_array[p_i, 3] += s
+
+    return peaks_ambience
+
+
+_peaks_ambience = _make_peaks_ambience(inverse=False)
+_peaks_ambience_inv = _make_peaks_ambience(inverse=True)
 
 
 @numba.njit
@@ -26,22 +26,24 @@ from datetime import datetime, timedelta, timezone
 import logging
 import multiprocessing
 import npshmex
-import signal
 import socket
 import shutil
 import time
 import traceback
 import numpy as np
 import pymongo
-from psutil import pid_exists, disk_usage, Process
+from psutil import pid_exists, disk_usage, wait_procs, Process, NoSuchProcess
 import pytz
+import random
+import re
 import strax
 import straxen
 import threading
-import pandas as pd
 import daqnt
 import fnmatch
+import heapq
 from glob import glob
+from operator import attrgetter
 from straxen import daq_core
 from straxen.daq_core import now
 
@@ -165,9 +167,11 @@ timeouts = {
     "check_on_strax": 10,
     # Maximum time a run is 'busy' without a further update from
     # its responsible bootstrax. Bootstrax normally updates every
-    # check_on_strax seconds, so make sure this is substantially
-    # larger than check_on_strax.
+    # busy_state_interval seconds, so make sure this is substantially
+    # larger than busy_state_interval.
     "max_busy_time": 120,
+    # While processing, update the 'busy' state of the run at most this often
+    "busy_state_interval": 30,
     # Maximum time a run is in the 'considering' state
     # if exceeded, will be labeled as an untracked failure
     "max_considering_time": 60,
@@ -183,6 +187,8 @@ timeouts = {
     # for a longer period of time, the ebs0-2 can also help with
     # processing.
     "eb3-5_max_busy_time": 5 * 60,
+    # Ebs0-2 check if eb3-5 are running and busy, this status is cached for this long
+    "eb3-5_status_cache": 30,
     # Bootstrax writes it's state to the daq-database. To have a backlog we store this
     # state using a TTL collection. To prevent too many entries in this backlog, only
     # create new entries if the previous entry is at least this old (in seconds).
@@ -195,18 +201,26 @@ timeouts = {
     # should not be on the DAQ any way or can be manually failed using the
     # --abandon option. We can abandon a run only for this many seconds:
     "abandoning_allowed": 3600 * 24 * 1,
+    # The bootstrax config in the daq-database rarely changes, only fetch it again
+    # if the cached version is older than this many seconds
+    "bootstrax_config_cache": 60,
 }
+if timeouts["max_busy_time"] < 2 * (timeouts["busy_state_interval"] + timeouts["check_on_strax"]):
+    raise ValueError("busy_state_interval too large")
 
 # The disk that the eb is writing to may fill up at some point. The data should
 # be written to datamanager at some point. This may clean up data on the disk,
 # hence, we can check if there is sufficient diskspace and if not, wait a while.
 # Below are the max number of times and number of seconds bootstrax will wait.
+# The time between checks doubles on every check, up to wait_diskspace_dt_max, bootstrax
+# gives up after the total time it would take to check n_max times every dt seconds.
 wait_diskspace_max_space_percent = 95
 min_disk_space_tb = 1.0  # Terabytes
 wait_diskspace_n_max = 60 * 24 * 7  # times
 wait_diskspace_dt = 10  # seconds
-if timeouts["bootstrax_presumed_dead"] < wait_diskspace_dt:
-    raise ValueError("wait_diskspace_dt too large")
+wait_diskspace_dt_max = 80  # seconds
+if timeouts["bootstrax_presumed_dead"] < wait_diskspace_dt_max:
+    raise ValueError("wait_diskspace_dt_max too large")
 
 # Fields in the run docs that bootstrax uses. Pay attention to the tailing spaces!
 bootstrax_projection = (
@@ -270,25 +284,70 @@ remove_target_after_fails = {
     "detector_time_*": 6,
     "*": 7,
 }
+# The same, with the patterns compiled once, see keep_target
+_remove_target_patterns = [
+    (re.compile(fnmatch.translate(pattern)), n_fails)
+    for pattern, n_fails in remove_target_after_fails.items()
+]
+
+# Special modes override the targets and post processing targets of runs that have any of
+# these strings in their mode. The first match is used.
+special_mode_targets = (
+    # led-mode
+    (("pmtgain",), "led_calibration", "raw_records"),
+    # afterpulse mode
+    (("pmtap",), "afterpulses", "raw_records"),
+    # NV reflectivity and diffuser ball mode
+    (("nVeto_LASER_calibration",), "ref_mon_nv", "raw_records"),
+    # diagnostic-mode
+    (
+        ("exttrig", "noise", "mv_diffuserballs", "mv_fibres", "mv_darkrate"),
+        "raw_records",
+        "raw_records",
+    ),
+)
+
+# Safe parameters for running bootstrax at a given uncompressed data rate (in MB/s), see
+# infer_mode. Missing values are linearly interpolated between their neighbours.
+benchmark = {
+    "mbs": [0, 70, 90, 110, 150, 220, 290, 360, 390, 420, 500, 550],
+    "cores_old": [39, 35, 35, 30, 30, 20, 12, 12, 10, 10, 10, 8],
+    "cores": [24, 24, 24, 24, 18, 15, 15, 15, 15, 15, 15, 10],
+    "max_messages_old": [20, 20, 15, 15, 10, 10, 10, 10, 10, 10, 8, 6],
+    "max_messages": [60, 60, 35, 30, 25, 25, 25, 25, 20, 15, 12, 12],
+    "timeout": [1200, 1200, None, None, None, None, None, None, None, None, None, 2400],
+}
+# The same, as the data rates and values of the given points per parameter for np.interp
+benchmark_points = {
+    k: (
+        np.array([mbs for mbs, v in zip(benchmark["mbs"], values) if v is not None], float),
+        np.array([v for v in values if v is not None], float),
+    )
+    for k, values in benchmark.items()
+    if k != "mbs"
+}
+
+# Compressors for the (raw)records, see infer_records_compressor. The first entry for which
+# the data rate (MB/s) is below the first and the chunk size (MB) at most the second value
+# is used.
+records_compressors = (
+    # Low data rate, we can do very large compression
+    (65, float("inf"), "zstd"),
+    # High datarate and reasonable chunk size.
+    (float("inf"), 1800, "zstd"),
+    # Extremely large chunks, let's use LZ4 because we know that it can handle this.
+    (float("inf"), float("inf"), "lz4"),
+)
+# Data types that are written with the compressor from infer_records_compressor
+records_compressor_types = ("raw_records", "records", "records_nv", "hitlets_nv")
 
 ##
 # Initialize globals (e.g. rundb connection)
 ##
 hostname = socket.getfqdn()
 
-versions = straxen.print_versions(
-    modules="strax straxen utilix daqnt numpy tensorflow numba".split(),
-    include_git=True,
-    return_string=True,
-)
-
 log_name = "bootstrax_" + hostname + ("" if args.production else "_TESTING")
-log = daqnt.get_daq_logger(
-    log_name,
-    log_name,
-    level=logging.DEBUG,
-    opening_message=f"I am processing with these software versions: {versions}",
-)
+log = daqnt.get_daq_logger(log_name, log_name, level=logging.DEBUG)
 
 # Set the output folder
 output_folder = daq_core.pre_folder if args.production else test_data_folder
@@ -354,7 +413,10 @@ def new_context(
 
 st = new_context()
 
-databases = daq_core.DataBases(production=args.production)
+# Bootstrax only needs a few connections at a time, name them after this host
+databases = daq_core.DataBases(
+    production=args.production, appname=f"bootstrax_{hostname}", maxPoolSize=10
+)
 run_db = databases.run_db
 daq_db = databases.daq_db
 run_coll = databases.run_coll
@@ -365,9 +427,31 @@ run_db.command("ping")
 
 # Ping the databases to ensure the mongo connections are working
 if not args.undying:
-    run_db.command("ping")
     daq_db.command("ping")
 
+if args.production:
+    # Indexes for the queries bootstrax repeats every iteration of the main loop,
+    # see run_queries. Creating an index that already exists is a no-op
+    run_coll.create_index(
+        [
+            ("bootstrax.state", pymongo.ASCENDING),
+            ("bootstrax.next_retry", pymongo.ASCENDING),
+            ("bootstrax.n_failures", pymongo.ASCENDING),
+        ],
+        name="bs_retry_idx",
+    )
+    run_coll.create_index(
+        [("bootstrax.state", pymongo.ASCENDING), ("detectors", pymongo.ASCENDING)],
+        name="bs_state_det_idx",
+    )
+    # Indexes for finding the last status of a host, see set_state, eb3_5_status and cleanup_db
+    bs_coll.create_index(
+        [("host", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], name="bs_host_id_desc"
+    )
+    bs_coll.create_index(
+        [("host", pymongo.ASCENDING), ("time", pymongo.DESCENDING)], name="bs_host_time_desc"
+    )
+
 
 def run():
     if args.cores == -1:
@@ -386,6 +470,7 @@ def run():
         abandon(number=number)
 
     elif args.process:
+        log_versions()
         t_start = now()
         number = args.process
 
@@ -416,9 +501,25 @@ def run():
 
     else:
         # Start processing
+        log_versions()
         loop()
 
 
+def log_versions():
+    """Log the software versions we are processing with.
+
+    Only done when we are going to process, as the versions of git installs take a while to
+    look up.
+
+    """
+    versions = straxen.print_versions(
+        modules="strax straxen utilix daqnt numpy tensorflow numba".split(),
+        include_git=True,
+        return_string=True,
+    )
+    log.info(f"I am processing with these software versions: {versions}")
+
+
 ##
 # Main loop
 ##
@@ -441,24 +542,21 @@ def loop():
     # keep track of the ith run that we have seen when we are not in production mode
     new_runs_seen, failed_runs_seen = 0, 1
     while True:
-        log.info(f"bootstrax running for {(now() - t_start).total_seconds()} seconds")
+        log.info("bootstrax running for %s seconds", (now() - t_start).total_seconds())
         # Check resources are still OK, otherwise crash / reboot program
         sufficient_diskspace()
         log.info("Looking for work")
         set_state("busy")
-        if eb_can_process():
-            # Process new runs
-            rd = consider_run({"bootstrax.state": None}, test_counter=new_runs_seen)
-            if rd is not None:
-                new_runs_seen += 1
-                process_run(rd)
-                continue
-        else:
-            # We are on an old eb with not so much to do, perhaps one of
-            # the veto systems needs processing?
-            rd = consider_run(
-                {"detectors": {"$ne": "tpc"}, "bootstrax.state": None}, test_counter=new_runs_seen
-            )
+        queries = run_queries()
+        candidates = poll_run_db(queries, skip_new=new_runs_seen, skip_failed=failed_runs_seen)
+        # Process new runs, or if we are on an old eb with not so much to do,
+        # perhaps one of the veto systems needs processing?
+        kind = "new" if eb_can_process(candidates["n_untouched"]) else "veto"
+        if candidates[kind] is not None:
+            rd = consider_run(queries[kind], candidate=candidates[kind])
+            if rd is None:
+                # Another host claimed this run first, there may be more runs waiting
+                rd = consider_run(queries[kind])
             if rd is not None:
                 new_runs_seen += 1
                 process_run(rd)
@@ -472,14 +570,11 @@ def loop():
 
         # Any failed runs to retry?
         # Only try one run, we want to be back for new runs quickly
-        rd = consider_run(
-            {
-                "bootstrax.state": "failed",
-                "bootstrax.n_failures": {"$lt": max_n_retry},
-                "bootstrax.next_retry": {"$lt": now()},
-            },
-            test_counter=failed_runs_seen,
-        )
+        rd = None
+        if candidates["failed"] is not None:
+            rd = consider_run(queries["failed"], candidate=candidates["failed"])
+            if rd is None:
+                rd = consider_run(queries["failed"])
 
         if rd is not None:
             failed_runs_seen += 1
@@ -495,7 +590,7 @@ def loop():
             break
         log.info("No work to do, waiting for new runs or retry timers")
         set_state("idle")
-        time.sleep(timeouts["idle_nap"])
+        wait_for_run_changes()
 
 
 ##
@@ -503,6 +598,66 @@ def loop():
 ##
 
 
+def watch_run_coll():
+    """Open a change stream on the runs-database for runs that may need processing: new runs and
+    runs of which the bootstrax state is reset or set to failed.
+
+    :return: the change stream or None if it cannot be opened (e.g. if the database is not a
+        replica set)
+
+    """
+    # Ignore all other updates, like the state and time that every bootstrax writes while
+    # considering or processing a run. Note that a missing field would match a null query.
+    new_state = "updateDescription.updatedFields.bootstrax.state"
+    pipeline = [
+        {
+            "$match": {
+                "$or": [
+                    {"operationType": "insert"},
+                    {"operationType": "update", new_state: "failed"},
+                    {"operationType": "update", new_state: {"$type": "null"}},
+                    {
+                        "operationType": "update",
+                        "updateDescription.removedFields": {
+                            "$in": ["bootstrax", "bootstrax.state"]
+                        },
+                    },
+                    {
+                        "operationType": "replace",
+                        "fullDocument.bootstrax.state": {"$in": [None, "failed"]},
+                    },
+                ]
+            }
+        }
+    ]
+    try:
+        return run_coll.watch(pipeline, max_await_time_ms=timeouts["idle_nap"] * 1000)
+    except pymongo.errors.PyMongoError as e:
+        log.warning(f"Cannot watch the runs-database ({e}), sleeping instead")
+        return None
+
+
+def wait_for_run_changes():
+    """Wait at most timeouts['idle_nap'] seconds for a run that may need processing.
+
+    The change stream is opened for each wait, so that no changes queue up while processing.
+    Changes in between the last poll of the runs-database and opening the stream are only seen
+    after the idle nap.
+
+    """
+    run_changes = watch_run_coll()
+    if run_changes is None:
+        time.sleep(timeouts["idle_nap"])
+        return
+    try:
+        with run_changes:
+            # Blocks for at most the max_await_time_ms of the change stream
+            run_changes.try_next()
+    except pymongo.errors.PyMongoError as e:
+        log.warning(f"Stopped watching the runs-database ({e}), sleeping instead")
+        time.sleep(timeouts["idle_nap"])
+
+
 def kill_process(pid):
     """Kill process pid."""
     log.warning(f"Kill PID:{pid}")
@@ -511,12 +666,20 @@ def kill_process(pid):
         return
 
     parent = Process(pid)
-    for child in parent.children(recursive=True):
-        child.kill()
-    parent.kill()
-
-    # Just make it extra dead
-    os.kill(pid, signal.SIGKILL)
+    processes = parent.children(recursive=True) + [parent]
+    for process in processes:
+        try:
+            process.terminate()
+        except NoSuchProcess:
+            pass
+    # Escalate to SIGKILL for the processes that did not stop in time
+    _, alive = wait_procs(processes, timeout=timeouts["signal_escalate"])
+    for process in alive:
+        try:
+            process.kill()
+        except NoSuchProcess:
+            pass
+    wait_procs(alive, timeout=timeouts["signal_escalate"])
 
     if pid_exists(pid):
         message = f"Could not kill process {pid}?!"
@@ -529,14 +692,14 @@ def _remove_veto_from_t(
     _flip: bool = False,
 ) -> ty.Union[str, list, tuple, None]:
     """Remove veto(s) from targets."""
-    start = strax.to_str_tuple(targets)
-    remove = strax.to_str_tuple(remove)
     if targets is None:
         return None
-    for r in remove:
-        targets = keep_target(targets, {f"*{r}": 0}, 1)
+    start = strax.to_str_tuple(targets)
+    remove = strax.to_str_tuple(remove)
+    targets = keep_target(targets, {f"*{r}": 0 for r in remove}, 1)
     if _flip:
-        targets = [t for i, t in enumerate(start) if not np.in1d(start, targets)[i]]
+        not_removed = set(targets)
+        targets = [t for t in start if t not in not_removed]
     return strax.to_str_tuple(targets)
 
 
@@ -547,28 +710,64 @@ def _keep_veto_from_t(
     """Remove non-veto(s) targets."""
     targets = _remove_veto_from_t(targets, remove=keep, _flip=True)  # type: ignore
     if not len(targets):
-        targets = strax.to_str_tuple("raw_records")
+        targets = ("raw_records",)
     return targets
 
 
 def keep_target(targets, compare_with, n_fails):
+    if compare_with is remove_target_after_fails:
+        patterns = _remove_target_patterns
+    else:
+        patterns = [
+            (re.compile(fnmatch.translate(pattern)), delete_after)
+            for pattern, delete_after in compare_with.items()
+        ]
     kept_targets = []
     delete_after = -1  # just to make logging never fail below
     for target_name in strax.to_str_tuple(targets):
-        for delete_target, delete_after in compare_with.items():
+        for delete_target, delete_after in patterns:
             failed_too_much = n_fails > delete_after
-            name_matches = fnmatch.fnmatch(target_name, delete_target)
-            if failed_too_much and name_matches:
+            if failed_too_much and delete_target.match(target_name):
                 log.warning(f"remove {target_name} ({n_fails}>{delete_after})")
                 break
         else:
-            log.debug(f"keep {target_name} ({n_fails}!>{delete_after})")
+            log.debug("keep %s (%s!>%s)", target_name, n_fails, delete_after)
             kept_targets.append(target_name)
     if not len(kept_targets):
         kept_targets = ["raw_records"]
     return kept_targets
 
 
+# Cache of the bootstrax config from the daq-database, see get_bootstrax_config
+_bootstrax_config_cache = {"t": 0, "doc": None}
+
+
+def get_bootstrax_config():
+    """Get the bootstrax config from the daq-database, refreshed at most every
+    timeouts['bootstrax_config_cache'] seconds."""
+    if time.time() - _bootstrax_config_cache["t"] >= timeouts["bootstrax_config_cache"]:
+        _bootstrax_config_cache["doc"] = daq_db["bootstrax_config"].find_one(
+            {"name": "bootstrax_config"}
+        )
+        _bootstrax_config_cache["t"] = time.time()
+    return _bootstrax_config_cache["doc"]
+
+
+def get_special_mode_targets(mode):
+    """Get the targets of a special mode, see special_mode_targets.
+
+    :param mode: mode of the run
+    :return: tuple of the targets and the targets for post processing, None if the mode is not
+        a special mode
+
+    """
+    for mode_names, targets, post_process in special_mode_targets:
+        if any(m in mode for m in mode_names):
+            log.debug("%s is a special mode, processing up to %s", mode, targets)
+            return targets, post_process
+    return None
+
+
 def infer_target(rd: dict) -> dict:
     """Check if the target should be overridden based on the mode of the DAQ for this run.
 
@@ -588,45 +787,19 @@ def infer_target(rd: dict) -> dict:
     n_fails = rd["bootstrax"].get("n_failures", 0)
 
     if n_fails:
-        log.debug(f"Deleting targets")
+        log.debug("Deleting targets")
         targets = keep_target(targets, remove_target_after_fails, n_fails)
         post_process = keep_target(post_process, remove_target_after_fails, n_fails)
 
-    log.debug(f"{targets} and {post_process} remaining")
+    log.debug("%s and %s remaining", targets, post_process)
 
-    # Special modes override target for these
-    led_modes = ["pmtgain"]
-    diagnostic_modes = [
-        "exttrig",
-        "noise",
-        "mv_diffuserballs",
-        "mv_fibres",
-        "mv_darkrate",
-    ]
-    ap_modes = ["pmtap"]
-    nv_ref_mon = [
-        "nVeto_LASER_calibration",
-    ]
     mode = str(rd.get("mode"))
     detectors = list(rd.get("detectors"))  # type: ignore
 
-    log.debug(f"mode is {mode}, changing target if needed")
-    if np.any([m in mode for m in led_modes]):
-        log.debug("led-mode")
-        targets = "led_calibration"
-        post_process = "raw_records"
-    elif np.any([m in mode for m in ap_modes]):
-        log.debug("afterpulse mode")
-        targets = "afterpulses"
-        post_process = "raw_records"
-    elif np.any([m in mode for m in nv_ref_mon]):
-        log.debug("NV reflecitvity and diffuser ball mode")
-        targets = "ref_mon_nv"
-        post_process = "raw_records"
-    elif np.any([m in mode for m in diagnostic_modes]):
-        log.debug("diagnostic-mode")
-        targets = "raw_records"
-        post_process = "raw_records"
+    log.debug("mode is %s, changing target if needed", mode)
+    special_targets = get_special_mode_targets(mode)
+    if special_targets is not None:
+        targets, post_process = special_targets
     elif "kr83m" in mode and (len(targets) or len(post_process)):
         # Override the first (highest level) plugin for Kr runs (could
         # also use source field, outcome is the same)
@@ -640,14 +813,13 @@ def infer_target(rd: dict) -> dict:
         # get the mode from the daq_db
         # this is a new thing from Nov 2023
         # it overwrites the mode from the rundb
-        bootstrax_config_coll = daq_db["bootstrax_config"]
-        bootstrax_config = bootstrax_config_coll.find_one({"name": "bootstrax_config"})
+        bootstrax_config = get_bootstrax_config()
 
         this_eb_ambe_mode = bootstrax_config["ambe_modes"].get(hostname[:3], "default")
-        log.debug(f"Ambe mode for {hostname} is {this_eb_ambe_mode}")
+        log.debug("Ambe mode for %s is %s", hostname, this_eb_ambe_mode)
 
         if this_eb_ambe_mode != "default":
-            log.debug(f"Overwriting targets and post processing for {hostname} from daq_db")
+            log.debug("Overwriting targets and post processing for %s from daq_db", hostname)
             targets = bootstrax_config["modes_definitions"][this_eb_ambe_mode]["targets"]
             post_process = bootstrax_config["modes_definitions"][this_eb_ambe_mode]["post_process"]
 
@@ -675,14 +847,13 @@ def infer_target(rd: dict) -> dict:
                 f"to {post_process}"
             )
 
+    # targets and post_process are tuples of str by now
     if targets is None or not len(targets):
-        targets = "raw_records"
+        targets = ("raw_records",)
     if post_process is None or not len(post_process):
-        post_process = "raw_records"
+        post_process = ("raw_records",)
 
-    targets = strax.to_str_tuple(targets)
-    post_process = strax.to_str_tuple(post_process)
-    log.info(f"Inferring modes done, writing {targets} and {post_process}")
+    log.info("Inferring modes done, writing %s and %s", targets, post_process)
     for check in (targets, post_process):
         if not len(set(check)) == len(check):
             log_warning(f"Duplicates in (post) targets {check}", priority="fatal")
@@ -697,34 +868,34 @@ def set_state(state, update_fields=None):
     if state is None, leave state unchanged, just update heartbeat time
 
     """
-    # Find the last message of this host
-    previous_entry = bs_coll.find_one({"host": hostname}, sort=[("_id", pymongo.DESCENDING)])
-    if state is None:
-        state = "None" if previous_entry is None else previous_entry.get("state")
-
     bootstrax_state = dict(
         host=hostname,
         pid=os.getpid(),
         time=now(),
-        state=state,
         targets=args.targets,
         max_cores=args.cores,
         max_messages=args.max_messages,
         undying=args.undying,
         production_mode=args.production,
     )
+    if state is not None:
+        bootstrax_state["state"] = state
     if update_fields:
         update_fields = strax.storage.mongo.remove_np(update_fields)
         bootstrax_state.update(update_fields)
 
-    need_new_doc = (previous_entry is None) or (
-        (now() - previous_entry["time"].replace(tzinfo=pytz.utc)).seconds
-        > timeouts["min_status_interval"]
+    # Update the last message of this host if it is recent, otherwise add a new one
+    previous_entry = bs_coll.find_one_and_update(
+        {"host": hostname, "time": {"$gt": now(-timeouts["min_status_interval"])}},
+        {"$set": bootstrax_state},
+        sort=[("_id", pymongo.DESCENDING)],
     )
-    if need_new_doc:
+    if previous_entry is None:
+        if state is None:
+            # Find the last message of this host to copy the state from
+            last_entry = bs_coll.find_one({"host": hostname}, sort=[("_id", pymongo.DESCENDING)])
+            bootstrax_state["state"] = "None" if last_entry is None else last_entry.get("state")
         bs_coll.insert_one(bootstrax_state)
-    else:
-        bs_coll.update_one({"_id": previous_entry["_id"]}, {"$set": bootstrax_state})
 
 
 def send_heartbeat(update_fields=None):
@@ -745,13 +916,14 @@ def log_warning(message, priority="warning", run_id=None):
     )
 
 
-def eb_can_process():
+def eb_can_process(n_untouched_runs):
     """The new ebs (eb3-5) should be sufficient to process all data. In exceptional circumstances
     eb3-5 cannot keep up. Only let eb0-2 also process data in such cases.
 
     Before eb0-2 are also used for processing two criteria have to be fulfilled:
         - There should be runs waiting to be processed
         - Eb3-5 should be busy processing for a substantial time.
+    :param n_untouched_runs: number of runs untouched by bootstrax
     :return: bool if this host should process a run
 
     """
@@ -767,10 +939,29 @@ def eb_can_process():
         log_warning("Why is eb2 alive?!", priority="error")
         return False
 
-    # Count number of runs untouched by bootstrax.
-    n_untouched_runs = run_coll.count_documents({"bootstrax.state": None})
+    n_ebs_running, n_ebs_busy = eb3_5_status()
+    log.info("running: %d\tbusy: %d\tqueue: %d", n_ebs_running, n_ebs_busy, n_untouched_runs)
+    if not n_ebs_running:
+        return True
+    if n_untouched_runs > max_queue_new_runs:
+        return True
+    return False
+
+
+# Cache of the status of eb3-5, see eb3_5_status
+_eb3_5_status_cache = {"t": 0, "value": None}
+
+
+def eb3_5_status():
+    """Check if eb3-5 are running and if they are busy processing for at least some time.
+
+    The result is cached for timeouts['eb3-5_status_cache'] seconds.
+    :return: number of eb3-5 running, number of eb3-5 busy
+
+    """
+    if time.time() - _eb3_5_status_cache["t"] < timeouts["eb3-5_status_cache"]:
+        return _eb3_5_status_cache["value"]
 
-    # Check that eb3-5 are all busy for at least some time.
     n_ebs_running = 0
     n_ebs_busy = 0
     for eb_i in range(3, 6):
@@ -794,13 +985,10 @@ def eb_can_process():
             )
             if running_eb:
                 n_ebs_busy += 1
-                log.debug(f"eb{eb_i} is busy")
-    log.info(f"running: {n_ebs_running}\tbusy: {n_ebs_busy}\tqueue: {n_untouched_runs}")
-    if not n_ebs_running:
-        return True
-    if n_untouched_runs > max_queue_new_runs:
-        return True
-    return False
+                log.debug("eb%d is busy", eb_i)
+    _eb3_5_status_cache["value"] = n_ebs_running, n_ebs_busy
+    _eb3_5_status_cache["t"] = time.time()
+    return n_ebs_running, n_ebs_busy
 
 
 def infer_mode(rd):
@@ -831,14 +1019,17 @@ def infer_mode(rd):
             time.sleep(time_to_wait)
         while data_rate == 0:
             # For runs that are still running, we should be able to get the
-            # info from the aggregate status collection.
+            # info from the aggregate status collection. The server aborts the
+            # aggregation if it takes longer than the time we have left.
+            time_left = timeouts["max_data_rate_infer_time"] - (time.time() - started_looking)
             docs = ag_stat_coll.aggregate(
                 [
                     {"$match": {"number": rd["number"]}},
                     {"$group": {"_id": "$detector", "rate": {"$max": "$rate"}}},
-                ]
+                ],
+                maxTimeMS=int(max(time_left, 1) * 1000),
             )
-            data_rate = float(sum([d["rate"] for d in docs]))
+            data_rate = float(sum(d["rate"] for d in docs))
             if data_rate > 0:
                 break
             elif time.time() - started_looking > timeouts["max_data_rate_infer_time"]:
@@ -859,14 +1050,6 @@ def infer_mode(rd):
     # Find out if eb is new (eb3-eb5):
     is_new_eb = int(hostname[2]) >= 3  # ebX.xenon.local
     log.info(f"Data rate: {data_rate:.1f} MB/s. New_eb: {is_new_eb}")
-    benchmark = {
-        "mbs": [0, 70, 90, 110, 150, 220, 290, 360, 390, 420, 500, 550],
-        "cores_old": [39, 35, 35, 30, 30, 20, 12, 12, 10, 10, 10, 8],
-        "cores": [24, 24, 24, 24, 18, 15, 15, 15, 15, 15, 15, 10],
-        "max_messages_old": [20, 20, 15, 15, 10, 10, 10, 10, 10, 10, 8, 6],
-        "max_messages": [60, 60, 35, 30, 25, 25, 25, 25, 20, 15, 12, 12],
-        "timeout": [1200, 1200, None, None, None, None, None, None, None, None, None, 2400],
-    }
     if data_rate and args.infer_mode:
 
         # Temporary solution
@@ -879,17 +1062,7 @@ def infer_mode(rd):
         if "ambe" in mode:
             data_rate = 550
 
-        df = pd.DataFrame(benchmark)
-        if data_rate not in benchmark["mbs"]:
-            df.loc[len(df.index)] = [data_rate, None, None, None, None, None]
-        df.set_index("mbs", inplace=True)
-        df.sort_values("mbs", inplace=True)
-        df.interpolate(method="index", inplace=True)
-        result = {k: int(v) for k, v in df.loc[data_rate].items()}
-        if not is_new_eb:
-            for k in ("cores", "max_messages"):
-                result[k] = result[k + "_old"]
-        del df, benchmark, result["cores_old"], result["max_messages_old"]
+        result = benchmark_resources(data_rate, is_new_eb)
     else:
         result = dict(cores=args.cores, max_messages=args.max_messages, timeout=1000)
 
@@ -902,10 +1075,11 @@ def infer_mode(rd):
 
     if n_fails:
         # Exponentially lower resources & increase timeout
+        scale = 1.1**n_fails
         result = dict(
-            cores=np.clip(result["cores"] / (1.1**n_fails), 4, 40).astype(int),
-            max_messages=np.clip(result["max_messages"] / (1.1**n_fails), 4, 100).astype(int),
-            timeout=np.clip(result["timeout"] * (1.1**n_fails), 500, 3600).astype(int),
+            cores=int(max(4, min(40, result["cores"] / scale))),
+            max_messages=int(max(4, min(100, result["max_messages"] / scale))),
+            timeout=int(max(500, min(3600, result["timeout"] * scale))),
         )
         log_warning(
             f'Repeated failures on {rd["number"]}@{hostname}. Lowering to {result}',
@@ -919,6 +1093,21 @@ def infer_mode(rd):
     return result
 
 
+def benchmark_resources(data_rate, is_new_eb):
+    """Interpolate the benchmark to get safe resources for running at data_rate.
+
+    :param data_rate: uncompressed data rate in MB/s
+    :param is_new_eb: if True, use the benchmarks of the new ebs (eb3-eb5)
+    :return: dict with the cores, max_messages and timeout
+
+    """
+    eb_suffix = "" if is_new_eb else "_old"
+    return {
+        k: int(np.interp(data_rate, *benchmark_points[k + suffix]))
+        for k, suffix in (("cores", eb_suffix), ("max_messages", eb_suffix), ("timeout", ""))
+    }
+
+
 def infer_records_compressor(rd, datarate, n_fails):
     """
     Get a compressor for the (raw)records. This takes two things in consideration:
@@ -936,14 +1125,10 @@ def infer_records_compressor(rd, datarate, n_fails):
 
     chunk_length = rd["daq_config"]["strax_chunk_overlap"] + rd["daq_config"]["strax_chunk_length"]
     chunk_size_mb = datarate * chunk_length
-    if datarate < 65:
-        # Low data rate, we can do very large compression
-        return "zstd"
-    if chunk_size_mb > 1800:
-        # Extremely large chunks, let's use LZ4 because we know that it
-        # can handle this.
-        return "lz4"
-    # High datarate and reasonable chunk size.
+    for below_datarate, max_chunk_size_mb, compressor in records_compressors:
+        if datarate < below_datarate and chunk_size_mb <= max_chunk_size_mb:
+            return compressor
+    # E.g. a NaN data rate, go for fast & safe
     return "zstd"
 
 
@@ -954,7 +1139,10 @@ def infer_records_compressor(rd, datarate, n_fails):
 
 def sufficient_diskspace():
     """Check if there is sufficient space available on the local disk to write to."""
-    for i in range(wait_diskspace_n_max):
+    give_up_at = time.time() + wait_diskspace_n_max * wait_diskspace_dt
+    dt = wait_diskspace_dt
+    i = 0
+    while time.time() < give_up_at:
         du = disk_usage(output_folder)
         disk_pct = du.percent
         disk_free = du.free / (1024**4)
@@ -966,12 +1154,14 @@ def sufficient_diskspace():
             # Log it once to the database, the first time. Otherwise, just log it locally
             log_warning(
                 f"Insufficient free disk space ({disk_pct:.1f}% full) on {hostname}. "
-                f"Waiting {i}/{wait_diskspace_n_max}",
+                f"Waiting at most {wait_diskspace_n_max * wait_diskspace_dt} s",
                 priority="warning",
             )
         else:
             log.warning(f"Insufficient free disk space ({disk_pct:.1f}% full)")
-        time.sleep(wait_diskspace_dt)
+        time.sleep(dt)
+        dt = min(2 * dt, wait_diskspace_dt_max)
+        i += 1
         send_heartbeat(dict(state="disk full"))
     set_state(dead_state)
     message = f"No disk space to write to. Kill bootstrax on {hostname}"
@@ -979,10 +1169,15 @@ def sufficient_diskspace():
     raise RuntimeError(message)
 
 
+# The thread that was last opened to delete live_data, see wait_on_delete_thread
+_delete_thread: ty.Optional[threading.Thread] = None
+
+
 def delete_live_data(rd, live_data_path):
     """Open thread to delete the live_data."""
+    global _delete_thread
     if args.production and os.path.exists(live_data_path) and args.delete_live:
-        delete_thread = threading.Thread(
+        _delete_thread = delete_thread = threading.Thread(
             name=delete_thread_name, target=_delete_data, args=(rd, live_data_path, "live")
         )
         log.info(f"Starting thread to delete {live_data_path} at {now()}")
@@ -1004,58 +1199,57 @@ def _delete_data(rd, path, data_type):
         log_warning(message, priority="fatal")
         raise ValueError(message)
     log.debug(f"Deleting data at {path}")
-    if os.path.exists(path):
+    try:
         shutil.rmtree(path)
+    except FileNotFoundError:
+        # Already gone
+        pass
+    except OSError as e:
+        message = f"Something went wrong we wanted to delete {path}! {e}"
+        log_warning(message, priority="fatal")
+        raise ValueError(message) from e
     log.info(f"deleting {path} finished")
     # Remove the data location from the rundoc and append it to the 'deleted_data' entries
-    if not os.path.exists(path):
-        log.info("changing data field in rundoc")
-        for ddoc in rd["data"]:
-            if ddoc["type"] == data_type:
-                break
-        for k in ddoc.copy().keys():
-            if k in ["location", "meta", "protocol"]:
-                ddoc.pop(k)
-
-        ddoc.update({"at": now(), "by": hostname})
-        log.debug(f"update with {ddoc}")
-        run_coll.update_one(
-            {"_id": rd["_id"]},
-            {
-                "$addToSet": {"deleted_data": ddoc},
-                "$pull": {"data": {"type": data_type, "host": {"$in": ["daq", hostname]}}},
-            },
-        )
-    else:
-        message = f"Something went wrong we wanted to delete {path}!"
+    log.info("changing data field in rundoc")
+    ddoc = next((d for d in rd["data"] if d["type"] == data_type), None)
+    if ddoc is None:
+        message = f"No {data_type} entry in the rundoc of {rd['number']} to remove"
         log_warning(message, priority="fatal")
         raise ValueError(message)
+    for k in ("location", "meta", "protocol"):
+        ddoc.pop(k, None)
+
+    ddoc.update({"at": now(), "by": hostname})
+    log.debug(f"update with {ddoc}")
+    run_coll.update_one(
+        {"_id": rd["_id"]},
+        {
+            "$addToSet": {"deleted_data": ddoc},
+            "$pull": {"data": {"type": data_type, "host": {"$in": ["daq", hostname]}}},
+        },
+    )
 
 
 def wait_on_delete_thread():
-    """Check that the thread with the delete_thread_name is finished before continuing."""
-    threads = threading.enumerate()
-    for thread in threads:
-        if thread.name == delete_thread_name:
-            done = False
-            while not done:
-                if thread.is_alive():
-                    log.info(f'{thread.name} still running take a {timeouts["idle_nap"]} s nap')
-                    time.sleep(timeouts["idle_nap"])
-                    done = True
+    """Check that the thread deleting the live_data is finished before continuing."""
+    while _delete_thread is not None and _delete_thread.is_alive():
+        log.info(f'{delete_thread_name} still running take a {timeouts["idle_nap"]} s nap')
+        _delete_thread.join(timeout=timeouts["idle_nap"])
+        send_heartbeat()
     log.info(f"Checked that {delete_thread_name} finished")
 
 
 def clear_shm():
     """Manually delete files in /dev/shm/ created by npshmex on starup."""
     shm_dir = "/dev/shm/"
-    shm_files = [f for f in os.listdir(shm_dir) if "npshmex" in f]
-
-    if not len(shm_files):
-        return
-    log.info(f"Clearing {len(shm_files)} files")
-    for f in shm_files:
-        os.remove(shm_dir + f)
+    n_cleared = 0
+    with os.scandir(shm_dir) as entries:
+        for entry in entries:
+            if "npshmex" in entry.name:
+                os.remove(entry.path)
+                n_cleared += 1
+    if n_cleared:
+        log.info(f"Cleared {n_cleared} files")
 
 
 ##
@@ -1070,10 +1264,7 @@ def ping_dbs():
             daq_db.command("ping")
             break
         except Exception as ping_error:
-            log.warning(
-                f"Failed to connect to Mongo. Ran into {ping_error}. Sleep for a minute.",
-                priority="warning",
-            )
+            log.warning(f"Failed to connect to Mongo. Ran into {ping_error}. Sleep for a minute.")
             time.sleep(60)
 
 
@@ -1084,15 +1275,43 @@ def get_run(*, mongo_id=None, number=None, full_doc=False):
         used by bootstrax.
 
     """
+    query = _run_query(mongo_id=mongo_id, number=number)
+    return run_coll.find_one(query, projection=None if full_doc else bootstrax_projection)
+
+
+def _fetch_data_docs(mongo_id, host):
+    """Return the entries of host in the 'data' field of the run doc matching mongo_id, without the
+    rest of the doc."""
+    rd = next(
+        run_coll.aggregate(
+            [
+                {"$match": {"_id": mongo_id}},
+                {
+                    "$project": {
+                        "data": {
+                            "$filter": {
+                                "input": "$data",
+                                "cond": {"$eq": ["$$this.host", host]},
+                            }
+                        }
+                    }
+                },
+            ]
+        ),
+        None,
+    )
+    # $filter gives null if the rundoc has no data field (yet)
+    return (rd or {}).get("data") or []
+
+
+def _run_query(*, mongo_id=None, number=None):
+    """Query for the run doc matching mongo_id or number."""
     if number is not None:
-        query = {"number": number}
+        return {"number": number}
     elif mongo_id is not None:
-        query = {"_id": mongo_id}
-    else:
-        # This means you are not running a normal bootstrax (no reason to report to rundb)
-        raise ValueError("Please give mongo_id or number")
-
-    return run_coll.find_one(query, projection=None if full_doc else bootstrax_projection)
+        return {"_id": mongo_id}
+    # This means you are not running a normal bootstrax (no reason to report to rundb)
+    raise ValueError("Please give mongo_id or number")
 
 
 def set_run_state(rd, state, return_new_doc=True, **kwargs):
@@ -1128,21 +1347,19 @@ def check_data_written(rd):
     """
     files_written = 0
 
-    # Fetch the rd again -> to see status of 'data' field
-    new_rd = get_run(mongo_id=rd["_id"], full_doc=True)
-    log.debug(new_rd["data"])
-    for ddoc in new_rd["data"]:
+    # Fetch the 'data' field of the rd again -> to see its status. Only
+    # the entries of this host are of interest, let mongo filter those.
+    host_data = _fetch_data_docs(rd["_id"], hostname)
+    log.debug(host_data)
+    for ddoc in host_data:
         ddoc_loc = ddoc.get("location", "NO LOCATION")
-        ddoc_host = ddoc.get("host", "NO HOST")
-        log.debug(f"Checking {ddoc_loc} on {ddoc_host} (current {hostname})")
-        if ddoc_host == hostname:
-            log.debug(f"Counting files {ddoc_loc} on {ddoc_host}")
-            if os.path.exists(ddoc_loc):
-                log.debug(f"{ddoc_loc} written")
-                files_written += 1
-            else:
-                log.info(f"No data at {ddoc_loc}")
-                return False
+        log.debug(f"Counting files {ddoc_loc} on {hostname}")
+        if os.path.exists(ddoc_loc):
+            log.debug(f"{ddoc_loc} written")
+            files_written += 1
+        else:
+            log.info(f"No data at {ddoc_loc}")
+            return False
     log.info(f"{files_written} files are saved")
     return files_written > 0
 
@@ -1211,34 +1428,89 @@ def abandon(*, mongo_id=None, number=None):
     set_run_state(get_run(mongo_id=mongo_id, number=number), "abandoned")
 
 
-def consider_run(query, return_new_doc=True, test_counter=0):
+def consider_run(query, return_new_doc=True, candidate=None):
     """Return one run doc matching query, and simultaneously set its bootstrax state to
-    'considering'."""
-    # We must first do an atomic find-and-update to set the run's state
+    'considering'.
+
+    :param candidate: run doc (e.g. from poll_run_db), if given only this run is considered,
+        provided it still matches the query
+
+    """
+    # We must do an atomic find-and-update to set the run's state
     # to "considering", to ensure the run doesn't get picked up by a
-    # bootstrax on another host.
+    # bootstrax on another host. The hostname and time are set at the
+    # same time, like set_run_state would do.
     if args.production:
-        rd = run_coll.find_one_and_update(
+        if candidate is not None:
+            query = {"_id": candidate["_id"], **query}
+        return run_coll.find_one_and_update(
             query,
-            {"$set": {"bootstrax.state": "considering"}},
+            {
+                "$set": {
+                    "bootstrax.state": "considering",
+                    "bootstrax.host": hostname,
+                    "bootstrax.time": now(),
+                }
+            },
             projection=bootstrax_projection,
-            return_document=True,
+            return_document=(
+                pymongo.ReturnDocument.AFTER if return_new_doc else pymongo.ReturnDocument.BEFORE
+            ),
             sort=[("start", pymongo.DESCENDING)],
         )
-        # Next, we can update the bootstrax entry properly with set_run_state
-        # (adding hostname, time, etc.)
-        if rd is None:
-            return None
-        return set_run_state(rd, "considering", return_new_doc=return_new_doc)
+    elif candidate is not None:
+        # Don't change the runs-database for test modes
+        return candidate
     else:
         # Don't change the runs-database for test modes
-        try:
-            rds = run_coll.find(
-                query, projection=bootstrax_projection, sort=[("start", pymongo.DESCENDING)]
-            )
-            return rds[test_counter]
-        except IndexError:
-            return None
+        return run_coll.find_one(
+            query, projection=bootstrax_projection, sort=[("start", pymongo.DESCENDING)]
+        )
+
+
+def run_queries():
+    """Queries for the runs bootstrax can pick up from the main loop: new runs, new runs without
+    the tpc and failed runs that should be retried."""
+    return {
+        "new": {"bootstrax.state": None},
+        "veto": {"detectors": {"$ne": "tpc"}, "bootstrax.state": None},
+        "failed": {
+            "bootstrax.state": "failed",
+            "bootstrax.n_failures": {"$lt": max_n_retry},
+            "bootstrax.next_retry": {"$lt": now()},
+        },
+    }
+
+
+def poll_run_db(queries, skip_new=0, skip_failed=0):
+    """Get the most recent run doc matching each of the queries (None if there is none) and the
+    number of runs untouched by bootstrax, in a single round trip to the runs-database.
+
+    :param queries: dict of the queries, see run_queries
+    :param skip_new: skip this many new runs, only used in test modes
+    :param skip_failed: skip this many failed runs, only used in test modes
+    :return: dict with a run doc (or None) per query and the number of untouched runs under
+        "n_untouched"
+
+    """
+    skip = {"new": skip_new, "veto": skip_new, "failed": skip_failed}
+    facets = {"n_untouched": [{"$match": {"bootstrax.state": None}}, {"$count": "n"}]}
+    for kind, query in queries.items():
+        facet = [{"$match": query}, {"$sort": {"start": pymongo.DESCENDING}}]
+        if not args.production and skip[kind]:
+            facet.append({"$skip": skip[kind]})
+        facet += [{"$limit": 1}, {"$project": {field: 1 for field in bootstrax_projection}}]
+        facets[kind] = facet
+    pipeline = [
+        # $facet cannot use indexes, so first select only runs that are in any of the facets.
+        # Each branch of the $or can use its own index, see the indexes created at startup
+        {"$match": {"$or": [*queries.values(), {"bootstrax.state": None}]}},
+        {"$facet": facets},
+    ]
+    result = next(run_coll.aggregate(pipeline))
+    candidates = {kind: (result[kind][0] if result[kind] else None) for kind in queries}
+    candidates["n_untouched"] = result["n_untouched"][0]["n"] if result["n_untouched"] else 0
+    return candidates
 
 
 def fail_run(rd, reason, error_traceback=""):
@@ -1280,7 +1552,7 @@ def fail_run(rd, reason, error_traceback=""):
             now(
                 plus=(
                     timeouts["retry_run"]
-                    * np.random.uniform(0.5, 1.5)
+                    * random.uniform(0.5, 1.5)
                     # Exponential backoff with jitter
                     * 5 ** min(rd["bootstrax"].get("n_failures", 0), 3)
                 )
@@ -1349,9 +1621,11 @@ def run_strax(
             timeout=timeout,
         )
 
-        for t in ("raw_records", "records", "records_nv", "hitlets_nv"):
-            # Set the (raw)records processor to the inferred one
-            st._plugin_class_registry[t].compressor = records_compressor
+        # Set the (raw)records processor to the inferred one. The registry may
+        # map several types to the same class, only set each class once.
+        registry = st._plugin_class_registry
+        for plugin_class in {registry[t] for t in records_compressor_types}:
+            plugin_class.compressor = records_compressor
 
         # Make a function for running strax, call the function to process the run
         # This way, it can also be run inside a wrapper to profile strax
@@ -1422,18 +1696,28 @@ def last_file_write_time(match_location: str) -> datetime:
     :return: TZ aware timestamp.
 
     """
-    last_time = datetime.fromtimestamp(0).replace(tzinfo=pytz.utc)
+    last_time = datetime.fromtimestamp(0, tz=timezone.utc)
     matched_folders = glob(match_location)
     for folder in matched_folders:
         # check last three files only
-        chunk_files = sorted(glob(os.path.join(folder, "*")))[-3:]
-        for chunk in chunk_files:
-            # Check that we did not rename this file since the glob above
-            if os.path.exists(chunk):
-                chunk_write_time = datetime.fromtimestamp(os.stat(chunk).st_mtime).replace(
-                    tzinfo=pytz.utc
+        try:
+            with os.scandir(folder) as entries:
+                chunk_files = heapq.nlargest(
+                    3,
+                    (entry for entry in entries if not entry.name.startswith(".")),
+                    key=attrgetter("name"),
                 )
-                last_time = max(last_time, chunk_write_time)
+        except (FileNotFoundError, NotADirectoryError):
+            # Not a folder, or renamed since the glob above
+            continue
+        for chunk in chunk_files:
+            try:
+                chunk_mtime = chunk.stat().st_mtime
+            except FileNotFoundError:
+                # We renamed this file since listing the folder
+                continue
+            chunk_write_time = datetime.fromtimestamp(chunk_mtime, tz=timezone.utc)
+            last_time = max(last_time, chunk_write_time)
     return last_time
 
 
@@ -1528,8 +1812,10 @@ def process_run(rd, send_heartbeats=args.production):
             clean_run_test_data(run_id)
 
         # Remove any temporary exception info from previous runs
-        if osp.exists(exception_tempfile):
+        try:
             os.remove(exception_tempfile)
+        except FileNotFoundError:
+            pass
 
         if not args.production and "bootstrax" not in rd:
             # Bootstrax does not register in non-production mode
@@ -1546,22 +1832,18 @@ def process_run(rd, send_heartbeats=args.production):
         run_strax_config["debug"] = args.debug
         strax_proc = multiprocessing.Process(target=run_strax, kwargs=run_strax_config)
 
+        # The config does not change while processing, report the same fields every heartbeat
+        to_report = ["run_id", "targets", "cores", "max_messages", "timeout", "post_processing"]
+        heartbeat_update = {k: v for k, v in run_strax_config.items() if k in to_report}
+
         t0 = now()
         info = dict(started_processing=t0)
+        last_state_update = None
         strax_proc.start()
 
         while True:
             if send_heartbeats:
-                to_report = [
-                    "run_id",
-                    "targets",
-                    "cores",
-                    "max_messages",
-                    "timeout",
-                    "post_processing",
-                ]
-                update = {k: v for k, v in run_strax_config.items() if k in to_report}
-                send_heartbeat(update)
+                send_heartbeat(heartbeat_update)
             ec = strax_proc.exitcode
             if ec is None:
                 # fail(bla) raises RunFailed so no need for elifs. Make sure to
@@ -1597,10 +1879,14 @@ def process_run(rd, send_heartbeats=args.production):
                         f" from {last_write}"
                     )
 
-                if args.production:
+                if args.production and (
+                    last_state_update is None
+                    or time.time() - last_state_update > timeouts["busy_state_interval"]
+                ):
                     set_run_state(rd, "busy", **info)
+                    last_state_update = time.time()
                 time.sleep(timeouts["check_on_strax"])
-                log.info(f"Still processing run {run_id}. PID:{strax_proc.pid}")
+                log.info("Still processing run %s. PID:%d", run_id, strax_proc.pid)
                 continue
 
             elif ec == 0:
@@ -1657,8 +1943,8 @@ def process_run(rd, send_heartbeats=args.production):
                     # Lets assume some ridiculous timestamp (in ns): 10e9*1e9
                     t_covered = timedelta(
                         seconds=(
-                            max([x.get("last_endtime", 0) for x in md["chunks"]])
-                            - min([x.get("first_time", 10e9 * 1e9) for x in md["chunks"]])
+                            max(x.get("last_endtime", 0) for x in md["chunks"])
+                            - min(x.get("first_time", 10e9 * 1e9) for x in md["chunks"])
                         )
                         / 1e9
                     )
@@ -1695,12 +1981,12 @@ def process_run(rd, send_heartbeats=args.production):
                 # This is just the info that we're starting
                 # exception retrieval. The actual error comes later.
                 log.info(f"Failure while processing run {run_id}")
-                if osp.exists(exception_tempfile):
-                    with open(exception_tempfile, mode="r") as f:
+                try:
+                    with open(exception_tempfile, mode="r", errors="replace") as f:
                         exc_info = f.read()
                     if not exc_info:
                         exc_info = "[No exception info known, exception file was empty?!]"
-                else:
+                except FileNotFoundError:
                     exc_info = "[No exception info known, exception file not found?!]"
                 fail(
                     f"Strax exited with exit code {ec}.",
@@ -1723,27 +2009,44 @@ def clean_run(*, mongo_id=None, number=None, force=False):
 
     """
     # We need to get the full data docs here, since I was too lazy to write
-    # a surgical update below
-    rd = get_run(mongo_id=mongo_id, number=number, full_doc=True)
-    have_live_data = False
-    for dd in rd["data"]:
-        if dd["type"] == "live":
-            have_live_data = True
-            break
+    # a surgical update below. Only the entries of this host are of interest
+    # though, let mongo filter those and check if there is any live data.
+    query = _run_query(mongo_id=mongo_id, number=number)
+    rd = next(
+        run_coll.aggregate(
+            [
+                {"$match": query},
+                {"$limit": 1},
+                {
+                    "$project": {
+                        "number": 1,
+                        "data": {
+                            "$filter": {
+                                "input": "$data",
+                                "cond": {"$eq": ["$$this.host", hostname]},
+                            }
+                        },
+                        "have_live_data": {"$in": ["live", {"$ifNull": ["$data.type", []]}]},
+                    }
+                },
+            ]
+        ),
+        None,
+    )
+    if rd is None:
+        raise ValueError(f"No run found to clean for {query}")
+    rd["data"] = rd["data"] or []
     for ddoc in rd["data"]:
-        if "host" in ddoc and ddoc["host"] == hostname:
-            loc = ddoc["location"]
-            if not force and not have_live_data and "raw_records" in ddoc["type"]:
-                log.info(
-                    f"prevent {loc} from being deleted. The live_data has already been removed"
-                )
-            elif os.path.exists(loc):
-                log.info(f"delete data at {loc}")
-                _delete_data(rd, loc, ddoc["type"])
-            else:
-                loc = loc + "_temp"
-                log.info(f"delete data at {loc}")
-                _delete_data(rd, loc, ddoc["type"])
+        loc = ddoc["location"]
+        if not force and not rd["have_live_data"] and "raw_records" in ddoc["type"]:
+            log.info(f"prevent {loc} from being deleted. The live_data has already been removed")
+        elif os.access(loc, os.F_OK):
+            log.info(f"delete data at {loc}")
+            _delete_data(rd, loc, ddoc["type"])
+        else:
+            loc = loc + "_temp"
+            log.info(f"delete data at {loc}")
+            _delete_data(rd, loc, ddoc["type"])
 
     # Also wipe the online_monitor if there is any
     run_db["online_monitor"].delete_many({"number": int(rd["number"])})
@@ -1751,10 +2054,12 @@ def clean_run(*, mongo_id=None, number=None, force=False):
 
 def clean_run_test_data(run_id):
     """Clean the data in the test_data_folder associated with this run_id."""
-    for folder in os.listdir(test_data_folder):
-        if run_id in folder:
-            log.info(f"Cleaning {test_data_folder + folder}")
-            shutil.rmtree(test_data_folder + folder)
+    with os.scandir(test_data_folder) as entries:
+        for entry in entries:
+            # Data folders are named {run_id}-{data_type}-{lineage_hash}
+            if entry.name.startswith(run_id):
+                log.info(f"Cleaning {entry.path}")
+                shutil.rmtree(entry.path)
 
 
 def cleanup_db():
@@ -1770,36 +2075,42 @@ def cleanup_db():
 
     # Check for all the ebs if their last state message is not longer
     # ago than the time we assume that the eb is dead.
-    for eb_i in range(6):
-        bd = bs_coll.find_one(
-            {"host": f"eb{eb_i}.xenon.local"}, sort=[("time", pymongo.DESCENDING)]
-        )
-        if (
-            bd
-            and bd["time"].replace(tzinfo=pytz.utc) < now(-timeouts["bootstrax_presumed_dead"])
-            and bd["state"] is not dead_state
-        ):
-            bs_coll.find_one_and_update({"_id": bd["_id"]}, {"$set": {"state": dead_state}})
+    dead_entries = bs_coll.aggregate(
+        [
+            {"$match": {"host": {"$in": [f"eb{eb_i}.xenon.local" for eb_i in range(6)]}}},
+            {"$sort": {"time": pymongo.DESCENDING}},
+            {
+                "$group": {
+                    "_id": "$host",
+                    "last_id": {"$first": "$_id"},
+                    "time": {"$first": "$time"},
+                    "state": {"$first": "$state"},
+                }
+            },
+            {
+                "$match": {
+                    "time": {"$lt": now(-timeouts["bootstrax_presumed_dead"])},
+                    "state": {"$ne": dead_state},
+                }
+            },
+        ]
+    )
+    dead_ids = [bd["last_id"] for bd in dead_entries]
+    if dead_ids:
+        bs_coll.update_many({"_id": {"$in": dead_ids}}, {"$set": {"state": dead_state}})
 
     # Runs that say they are 'considering' or 'busy' but nothing happened for a while
-    for state, timeout in [
-        ("considering", timeouts["max_considering_time"]),
-        ("busy", timeouts["max_busy_time"]),
-    ]:
-        while True:
-            send_heartbeat()
-            rd = consider_run(
-                {"bootstrax.state": state, "bootstrax.time": {"$lt": now(-timeout)}},
-                return_new_doc=False,
-            )
-            if rd is None:
-                break
-            fail_run(
-                rd,
-                f"Host {rd['bootstrax']['host']} said it was {state} "
-                f"at {rd['bootstrax']['time']}, but then didn't get further; "
-                "perhaps it crashed on this run or is still stuck?",
-            )
+    stuck_queries = [
+        (
+            {"bootstrax.state": state, "bootstrax.time": {"$lt": now(-timeout)}},
+            f"Host {{bootstrax[host]}} said it was {state} at {{bootstrax[time]}}, but then "
+            "didn't get further; perhaps it crashed on this run or is still stuck?",
+        )
+        for state, timeout in [
+            ("considering", timeouts["max_considering_time"]),
+            ("busy", timeouts["max_busy_time"]),
+        ]
+    ]
 
     # Runs for which, based on the run doc alone, we can tell they are in a bad state
     # Mark them as failed.
@@ -1817,14 +2128,6 @@ def cleanup_db():
         ),
     ]
 
-    for query, failure_message in failure_queries:
-        while True:
-            send_heartbeat()
-            rd = consider_run(query)
-            if rd is None:
-                break
-            fail_run(rd, failure_message.format(**rd))
-
     # Abandon runs which we already know are so bad that
     # there is no point in retrying them
     abandon_queries = [
@@ -1842,15 +2145,35 @@ def cleanup_db():
         ),
     ]
 
-    for query, failure_message in abandon_queries:
-        failure_message += " -- run has been abandoned"
-        while True:
+    bad_run_queries = [
+        (query, message, False) for query, message in stuck_queries + failure_queries
+    ] + [
+        (query, message + " -- run has been abandoned", True) for query, message in abandon_queries
+    ]
+    # Usually there are no such runs, so look for all of them in a single round trip
+    facets = {
+        str(i): [{"$match": query}, {"$project": {field: 1 for field in bootstrax_projection}}]
+        for i, (query, _, _) in enumerate(bad_run_queries)
+    }
+    pipeline = [
+        # $facet cannot use indexes, so first select only runs that are in any of the facets
+        {"$match": {"$or": [query for query, _, _ in bad_run_queries]}},
+        {"$sort": {"start": pymongo.DESCENDING}},
+        {"$facet": facets},
+    ]
+    bad_runs = next(run_coll.aggregate(pipeline))
+
+    for i, (query, failure_message, abandon_run) in enumerate(bad_run_queries):
+        for candidate in bad_runs[str(i)]:
             send_heartbeat()
-            rd = consider_run(query)
+            # Another host may have gotten to this run first, only continue if we claim it.
+            # Get the doc as it was before, the message may refer to the previous state.
+            rd = consider_run(query, return_new_doc=False, candidate=candidate)
             if rd is None:
-                break
-            fail_run(rd, failure_message.format(**rd))
-            abandon(mongo_id=rd["_id"])
+                continue
+            fail_run(rd, failure_message.format_map(rd))
+            if abandon_run:
+                abandon(mongo_id=rd["_id"])
 
 
 def main():
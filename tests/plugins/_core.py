@@ -1,5 +1,6 @@
 import strax
 from unittest import TestCase
+import functools
 import tempfile
 from straxen.test_utils import nt_test_run_id
 import straxen
@@ -37,6 +38,14 @@ class PluginTestAccumulator:
         return wrapper(func) if func is not None else wrapper
 
 
+@functools.lru_cache(maxsize=1)
+def cached_nt_test_context() -> strax.Context:
+    """Test context shared by all the test classes in this session, don't change it but make a
+    new_context from it instead."""
+    # TODO: xenonnt_online should be used here
+    return straxen.test_utils.nt_test_context("xenonnt")
+
+
 class PluginTestCase(TestCase):
     """Class for type hinting of PluginTest."""
 
@@ -71,14 +80,14 @@ class SetupContextNt(PluginTestCase):
         class. Only after running all the tests, we run the cleanup.
 
         """
-        # TODO: xenonnt_online should be used here
-        cls.st = straxen.test_utils.nt_test_context("xenonnt")
+        st = cached_nt_test_context()
         cls.run_id = nt_test_run_id
 
         # Make sure that we only write to the temp-dir we cleanup after each test
-        cls.st.storage[0].readonly = True
+        st.storage[0].readonly = True
         cls.tempdir = tempfile.TemporaryDirectory()
-        cls.st.storage.append(strax.DataDirectory(cls.tempdir.name))
+        # Each class gets its own copy, so changes (e.g. registering plugins) do not leak
+        cls.st = st.new_context(storage=strax.DataDirectory(cls.tempdir.name))
 
     @classmethod
     def tearDownClass(cls) -> None:
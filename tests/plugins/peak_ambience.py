@@ -0,0 +1,167 @@
+"""Run with python tests/plugins/peak_ambience.py."""
+
+from _core import PluginTestAccumulator, PluginTestCase, run_pytest_from_main
+import numpy as np
+import strax
+from straxen.plugins.peaks import peak_ambience
+
+
+def _get_ambience_data(n_peaks=500, n_hits=5000, n_channels=494, seed=0):
+    """Random peaks and lone hits, the peaks are disjoint like the ones from strax."""
+    rng = np.random.default_rng(seed)
+    span = int(1e8)
+    dtype = [
+        ("center_time", np.int64),
+        ("area", np.float32),
+        ("type", np.int8),
+        ("x", np.float32),
+        ("y", np.float32),
+    ] + strax.time_fields
+    peaks = np.zeros(n_peaks, dtype)
+    peaks["time"] = np.sort(rng.choice(span, n_peaks, replace=False))
+    gap = np.diff(peaks["time"], append=span + 20000)
+    length = np.minimum(rng.integers(10, 20000, n_peaks), gap)
+    peaks["endtime"] = peaks["time"] + length
+    peaks["center_time"] = peaks["time"] + (length * rng.random(n_peaks)).astype(np.int64)
+    peaks["area"] = rng.exponential(40, n_peaks)
+    peaks["type"] = rng.integers(0, 4, n_peaks)
+    peaks["x"] = rng.uniform(-30, 30, n_peaks)
+    peaks["y"] = rng.uniform(-30, 30, n_peaks)
+    # Peaks without a position
+    no_position = rng.random(n_peaks) < 0.1
+    peaks["x"][no_position] = np.nan
+    peaks["y"][no_position] = np.nan
+
+    lone_hits = np.zeros(n_hits, strax.hit_dtype)
+    lone_hits["time"] = np.sort(rng.integers(0, span, n_hits))
+    lone_hits["dt"] = 10
+    # Same length for all, so that the endtime is sorted too
+    lone_hits["length"] = 20
+    lone_hits["channel"] = rng.integers(0, n_channels, n_hits)
+    lone_hits["area"] = rng.normal(2, 2, n_hits)
+    return peaks, lone_hits
+
+
+def _brute_force_ambience(plugin, peaks, lone_hits):
+    """Straightforward calculation for every peak over all lonehits and small peaks."""
+    window = plugin.ambience_time_window_backward
+    exponent_dt, exponent_dr = plugin.ambience_exponents
+    radius = plugin.ambient_radius
+    small = np.zeros(len(peaks), dtype=bool)
+    for stype, area in zip([0, 1, 2], plugin.ambience_area_parameters):
+        small |= (peaks["type"] == stype) & (peaks["area"] < area)
+    pre_peaks = peaks[small]
+    hit_area = lone_hits["area"] * plugin.to_pe[lone_hits["channel"]]
+
+    result = np.zeros(len(peaks), plugin.dtype)
+    for p_i, peak in enumerate(peaks):
+        center_time = peak["center_time"]
+        # Things touching the window [center_time - window, center_time)
+        mask = (strax.endtime(lone_hits) > center_time - window) & (lone_hits["time"] < center_time)
+        mask &= lone_hits["area"] > 0
+        dt = (center_time - lone_hits["time"][mask]).astype(np.float64)
+        result[p_i]["n_lh_before"] = np.sum(mask)
+        result[p_i]["s_lh_before"] = np.sum(hit_area[mask] * dt**exponent_dt)
+
+        mask = (pre_peaks["endtime"] > center_time - window) & (pre_peaks["time"] < center_time)
+        mask &= pre_peaks["center_time"] < center_time
+        dt = (center_time - pre_peaks["center_time"]).astype(np.float64)
+        score = pre_peaks["area"] * np.where(mask, dt, 1) ** exponent_dt
+        for stype in [0, 1, 2]:
+            is_type = mask & (pre_peaks["type"] == stype)
+            result[p_i][f"n_s{stype}_before"] = np.sum(is_type)
+            result[p_i][f"s_s{stype}_before"] = np.sum(score[is_type])
+
+        is_s2 = mask & (pre_peaks["type"] == 2)
+        r = np.hypot(pre_peaks["x"] - peak["x"], pre_peaks["y"] - peak["y"]).astype(np.float64)
+        if radius < 0:
+            near = is_s2
+        else:
+            near = is_s2 & (r <= radius)
+        if radius > 0:
+            score = score * np.where(near, r, 1) ** exponent_dr
+        result[p_i]["n_s2_near"] = np.sum(near)
+        result[p_i]["s_s2_near"] = np.sum(score[near])
+
+    result["s_before"] = (
+        result["s_lh_before"]
+        + result["s_s0_before"]
+        + result["s_s1_before"]
+        + result["s_s2_before"]
+    )
+    result["time"] = peaks["time"]
+    result["endtime"] = peaks["endtime"]
+    return result
+
+
+@PluginTestAccumulator.register("test_peak_ambience_brute_force")
+def test_peak_ambience_brute_force(self: PluginTestCase):
+    """Compare the ambience to a brute force calculation, for the kernels with inverse exponents
+    (the default) and with general exponents."""
+    peaks, lone_hits = _get_ambience_data()
+    for config in (
+        dict(),
+        dict(ambience_exponents=(-0.5, -2.0)),
+        dict(ambient_radius=-1.0),
+        dict(ambient_radius=0.0),
+    ):
+        st = self.st.new_context()
+        st.set_config(config)
+        plugin = st.get_single_plugin(self.run_id, "peak_ambience")
+        result = plugin.compute(lone_hits, peaks)
+        expected = _brute_force_ambience(plugin, peaks, lone_hits)
+        for field in expected.dtype.names:
+            if field.startswith("n_") or field in ("time", "endtime"):
+                np.testing.assert_array_equal(result[field], expected[field], err_msg=field)
+            else:
+                np.testing.assert_allclose(
+                    result[field], expected[field], rtol=1e-4, err_msg=f"{field} with {config}"
+                )
+
+
+@PluginTestAccumulator.register("test_peak_ambience_inverse_kernels")
+def test_peak_ambience_inverse_kernels(self: PluginTestCase):
+    """The kernels specialized for exponents (-1, -1) should agree with the general ones."""
+    peaks, lone_hits = _get_ambience_data(seed=1)
+    plugin = self.st.get_single_plugin(self.run_id, "peak_ambience")
+    window_start = peaks["center_time"] - plugin.ambience_time_window_backward
+    window_end = peaks["center_time"]
+    exponents = (-1.0, -1.0)
+
+    positive = lone_hits[lone_hits["area"] > 0]
+    lonehits_args = (
+        peaks["center_time"],
+        positive["time"],
+        positive["area"].astype(np.float32),
+        *plugin.window_indices(positive["time"], strax.endtime(positive), window_start, window_end),
+        exponents,
+    )
+    results = []
+    for kernel in (peak_ambience._lonehits_ambience, peak_ambience._lonehits_ambience_inv):
+        num_array = np.zeros(len(peaks), dtype=np.int16)
+        sum_array = np.zeros(len(peaks), dtype=np.float32)
+        kernel(*lonehits_args, num_array, sum_array)
+        results.append((num_array, sum_array))
+    np.testing.assert_array_equal(results[0][0], results[1][0])
+    np.testing.assert_allclose(results[0][1], results[1][1], rtol=1e-5)
+
+    peaks_args = (
+        peaks["center_time"],
+        peaks["x"],
+        peaks["y"],
+        *plugin.gather_columns(peaks, np.arange(len(peaks)), window_start, window_end),
+        exponents,
+        plugin.ambient_radius,
+    )
+    results = []
+    for kernel in (peak_ambience._peaks_ambience, peak_ambience._peaks_ambience_inv):
+        num_array = np.zeros((len(peaks), 4), dtype=np.int16)
+        sum_array = np.zeros((len(peaks), 4), dtype=np.float32)
+        kernel(*peaks_args, num_array, sum_array)
+        results.append((num_array, sum_array))
+    np.testing.assert_array_equal(results[0][0], results[1][0])
+    np.testing.assert_allclose(results[0][1], results[1][1], rtol=1e-5)
+
+
+if __name__ == "__main__":
+    run_pytest_from_main()
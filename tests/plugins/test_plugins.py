@@ -1,7 +1,7 @@
 import strax
 import straxen
 import unittest
-from _core import PluginTestAccumulator, SetupContextNt
+from _core import PluginTestAccumulator, SetupContextNt, cached_nt_test_context
 import os
 import inspect
 
@@ -11,6 +11,7 @@ import posrec_plugins
 import event_building
 import nv_processing
 import local_minimum_plugin
+import peak_ambience
 
 
 # Don't bother with remote tests
@@ -20,7 +21,7 @@ class PluginTest(SetupContextNt, PluginTestAccumulator):
 
 
 # Very important step! We add a test for each of the plugins
-for _target in set(straxen.test_utils.nt_test_context("xenonnt")._plugin_class_registry.values()):
+for _target in set(cached_nt_test_context()._plugin_class_registry.values()):
     # Only run one test per plugin (even if it provides multiple targets)
     _target = strax.to_str_tuple(_target.provides)[0]
     if _target in PluginTest.exclude_plugins: